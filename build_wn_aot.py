@@ -0,0 +1,35 @@
+"""Ahead-of-time compilation of the winding number functions of wn.
+
+Run once with
+
+    python build_wn_aot.py
+
+to build the wn_aot extension module next to this file. When it can be
+imported, wn uses it for wn_pnpoly and wn_multipnpoly in place of the numba
+JIT functions, so there is no compilation on first call and numba is not
+needed at run time. skycoverage uses neither function, only the NumPy
+wn.wn_batchpnpoly, and is not affected.
+"""
+import os
+import sys
+
+
+def build():
+    # make sure wn does not pick up a previously built wn_aot module
+    sys.modules['wn_aot'] = None
+    from numba.pycc import CC
+    import wn
+
+    cc = CC('wn_aot')
+    cc.output_dir = os.path.dirname(os.path.abspath(__file__))
+    cc.export('wn_pnpoly', 'i4(f8[:], f8[:,:])')(wn.wn_pnpoly.py_func)
+    cc.export('wn_pnpoly_f4', 'i4(f4[:], f4[:,:])')(wn.wn_pnpoly.py_func)
+    cc.export('wn_multipnpoly', 'i4[:](f8[:,:], f8[:,:])')(
+        wn.wn_multipnpoly.py_func)
+    cc.export('wn_multipnpoly_f4', 'i4[:](f4[:,:], f4[:,:])')(
+        wn.wn_multipnpoly.py_func)
+    cc.compile()
+
+
+if __name__ == '__main__':
+    build()
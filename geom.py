@@ -1,57 +1,66 @@
 import numpy as np
 
 
-def to_vec(ang):
+def to_vec(ang, out=None):
     """Convert angular coordinates to vector.
 
     ang: shape [N, 2], unit: degrees, format: lon, lat
+    out: optional array of shape [N, 3] to write the result into
     returns vec: shape [N, 3], unit: none, format: x, y, z (norm=1)
     """
-    N = ang.shape[0]
     theta = np.pi/2 - np.radians(ang[:, 1])
     phi = np.radians(ang[:, 0])
-    xyz = np.zeros((N, 3))
     sp, cp = np.sin(phi), np.cos(phi)
     st, ct = np.sin(theta), np.cos(theta)
-    xyz[:, 0] = st*cp
-    xyz[:, 1] = st*sp
-    xyz[:, 2] = ct
-    return xyz
+    if out is None:
+        return np.stack([st*cp, st*sp, ct], axis=1)
+    np.multiply(st, cp, out=out[:, 0])
+    np.multiply(st, sp, out=out[:, 1])
+    out[:, 2] = ct
+    return out
 
 
-def to_ang(vec):
+def to_ang(vec, out=None):
     """Convert unit vectors to angular coordinates.
     
-    vec: shape [N, 3], format: x, y, z
-    returns ang: shape [N, 2], unit: degree, format: lon, lat
+    vec: shape [..., 3], format: x, y, z
+    out: optional array of shape [..., 2] to write the result into
+    returns ang: shape [..., 2], unit: degree, format: lon, lat
     """
-    N = vec.shape[0]
-    ang = np.zeros((N, 2))
-    ang[:, 0] = np.degrees(np.arctan2(vec[:, 1], vec[:, 0]))
-    r = np.sqrt((vec**2).sum(axis=1))
-    c = vec[:, 2] / r
-    ang[:, 1] = 90 - np.degrees(np.arccos(c))
-
-    return ang
+    if out is None:
+        out = np.empty(vec.shape[:-1] + (2,))
+    np.degrees(np.arctan2(vec[..., 1], vec[..., 0]), out=out[..., 0])
+    np.degrees(np.arcsin(np.clip(vec[..., 2], -1.0, 1.0)), out=out[..., 1])
+    return out
 
 
 def rot_mat(lon, lat):
+    """Rotation matrices from (0, 0) to (lon, lat), i.e. r_z(lon) @ r_y(lat).
+
+    lon, lat: scalars or arrays of the same shape, unit: degrees
+    returns r: shape lon.shape + (3, 3)
+    """
     c_lon, s_lon = np.cos(np.radians(lon)), np.sin(np.radians(lon))
     c_lat, s_lat = np.cos(np.radians(lat)), np.sin(np.radians(lat))
-    r_y = np.array([
-        [c_lat, 0, -s_lat],
-        [0, 1, 0],
-        [s_lat, 0, c_lat]
-    ])
-    r_z = np.array([
-        [c_lon, -s_lon, 0],
-        [s_lon, c_lon, 0],
-        [0, 0, 1]
-    ])
-    return np.matmul(r_z,r_y)
+    zero = np.zeros_like(c_lon)
+    return np.stack([
+        np.stack([c_lon*c_lat, -s_lon, -c_lon*s_lat], axis=-1),
+        np.stack([s_lon*c_lat, c_lon, -s_lon*s_lat], axis=-1),
+        np.stack([s_lat, zero, c_lat], axis=-1)
+    ], axis=-2)
 
 
 def rotate_to(lon, lat, ang):
+    """Rotate angular coordinates ang from (0, 0) to each (lon, lat).
+
+    Same as to_ang(to_vec(ang) @ rot_mat(lon, lat).T) for each (lon, lat):
+    the vectors of ang are computed once and rotated to all (lon, lat)
+    with a single batched matmul.
+    lon, lat: scalars or arrays of the same shape, unit: degrees
+    ang: shape [N, 2], unit: degrees, format: lon, lat
+    returns ang rotated: shape lon.shape + (N, 2), unit: degrees,
+        format: lon, lat
+    """
     r = rot_mat(lon, lat)
-    vec = np.matmul(to_vec(ang),r.T)
+    vec = np.matmul(to_vec(ang), np.swapaxes(r, -1, -2))
     return to_ang(vec)
@@ -1,5 +1,4 @@
 import skycoverage
-import matplotlib.pyplot as plt
 import numpy as np
 
 def get_layers(extent,size,targets,focalplane):
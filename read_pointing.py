@@ -2,16 +2,34 @@
 """
 
 import numpy as np
-import pylab as plt
 
-res = np.load('kraken_2026.npy')
 
-print(res.dtype, np.unique(res['proposalId']))
+def read_pointings(filename='kraken_2026.npy', proposal_id=3):
+    # memory-map the file, only the selected rows of the proposalId,
+    # fieldRA and fieldDec columns are read
+    res = np.load(filename, mmap_mode='r')
 
-idx = res['proposalId'] == 3
+    idx = np.flatnonzero(res['proposalId'] == proposal_id)
 
-sel = res[idx]
+    columns = ['fieldRA', 'fieldDec']
+    sel = np.empty(len(idx), dtype=[(c, res.dtype[c]) for c in columns])
+    for c in columns:
+        sel[c] = res[c][idx]
+    return sel
 
-plt.plot(sel['fieldRA'], sel['fieldDec'], 'ko')
 
-plt.show()
+def demo():
+    import pylab as plt
+    res = np.load('kraken_2026.npy', mmap_mode='r')
+
+    print(res.dtype, np.unique(res['proposalId']))
+
+    sel = read_pointings()
+
+    plt.plot(sel['fieldRA'], sel['fieldDec'], 'ko')
+
+    plt.show()
+
+
+if __name__ == '__main__':
+    demo()
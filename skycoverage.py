@@ -14,11 +14,28 @@
 #   - all healpix pixels (nside) within a rectangular zone RA_min, ...
 
 import json
+import os
 import numpy as np
 import argparse
+from concurrent.futures import ThreadPoolExecutor
 import geom
 import wn
 
+# Number of pixels per block of rows processed by a worker in coverage_all.
+PIXEL_CHUNK = 1024
+
+# Blocks are further split along y so that the (pixels, polygons, edges)
+# intermediate arrays of wn.wn_batchpnpoly fit in the L2 cache.
+# sysconf gives 0 or -1 when the size is unknown, fall back to 1 MiB.
+try:
+    L2_CACHE_SIZE = os.sysconf('SC_LEVEL2_CACHE_SIZE')
+except (AttributeError, ValueError, OSError):
+    L2_CACHE_SIZE = 0
+if L2_CACHE_SIZE <= 0:
+    L2_CACHE_SIZE = 2**20
+# Bytes of temporaries per (pixel, edge) pair in wn.wn_batchpnpoly
+EDGE_TEST_BYTES = 16
+
 
 def read_focal_plane(filename):
     with open(filename) as f:
@@ -55,40 +72,235 @@ def tuple_of(type):
 
 
 def make_pixels(extent, size):
+    """Axes x, y of the pixel grid, shapes (nx,) and (ny,).
+
+    The axes go from xmin to xmax and from ymin to ymax, so they decrease
+    if xmin > xmax or ymin > ymax. Pixel (i, j) is at (x[i], y[j]) and has
+    index i*ny + j in flat arrays.
+    Coordinates are float32, precise to ~0.1 arcsec.
+    """
     xmin, ymin, xmax, ymax = extent
     nx, ny = size
-    x = np.linspace(xmin, xmax, nx)
-    y = np.linspace(ymin, ymax, ny)
-    xy = np.array(np.meshgrid(x, y)).T.reshape(-1, 2)
-    return xy
+    x = np.linspace(xmin, xmax, nx, dtype=np.float32)
+    y = np.linspace(ymin, ymax, ny, dtype=np.float32)
+    return x, y
+
+
+def make_healpix_pixels(extent, nside):
+    """Healpix pixels (ring ordering) whose centers are within extent.
+
+    As in make_pixels, xmin > xmax or ymin > ymax give the same zone as the
+    sorted bounds.
+    returns ids: shape (n,), and lonlat: shape (n, 2), float32, with lon in
+    (-180, 180] like the polygons of make_polygons
+    """
+    import healpy as hp
+    x0, y0, x1, y1 = extent
+    xmin, xmax = min(x0, x1), max(x0, x1)
+    ymin, ymax = min(y0, y1), max(y0, y1)
+    ids = hp.query_strip(nside, np.radians(90 - ymax), np.radians(90 - ymin),
+                         inclusive=True)
+    lon, lat = hp.pix2ang(nside, ids, lonlat=True)
+    lon = np.where(lon > 180, lon - 360, lon)
+    keep = (lon >= xmin) & (lon <= xmax) & (lat >= ymin) & (lat <= ymax)
+    lonlat = np.stack([lon[keep], lat[keep]], axis=1).astype(np.float32)
+    return ids[keep], lonlat
 
 
 def make_polygons(targets, focalplane):
-    return [geom.rotate_to(ra, dec, focalplane) for ra, dec in targets]
+    """Focal plane rotated to each target, shape (n_targets, n_vertices, 2).
+
+    The rotation is done in float64, the polygons are returned as float32
+    like the pixels of make_pixels. The focal plane is closed if needed.
+    """
+    targets = np.asarray(targets, dtype=float)
+    focalplane = close_polygon(np.asarray(focalplane, dtype=float))
+    polygons = geom.rotate_to(targets[:, 0], targets[:, 1], focalplane)
+    return polygons.astype(np.float32)
 
 
 def close_polygon(polygon):
     """Check the last point in the polygon is identical to the first one, otherwise
     append it. Returns the updated polygon.
     """
-    if tuple(polygon[0]) != tuple(polygon[-1]):
-        new_polygon = np.zeros((len(polygon)+1, 2))
-        new_polygon[:-1, :] = polygon[...]
-        new_polygon[-1, :] = polygon[0, :]
-    else:
-        new_polygon = polygon.copy()
-    return new_polygon
+    if not np.array_equal(polygon[0], polygon[-1]):
+        return np.concatenate([polygon, polygon[:1]], axis=0)
+    return polygon.copy()
+
+
+def bounding_boxes(polygons):
+    """Bounding boxes xmin, ymin, xmax, ymax of polygons, shape (n_polygons, 4).
+    """
+    return np.concatenate([polygons.min(axis=-2), polygons.max(axis=-2)],
+                          axis=-1)
+
+
+def overlaps(values, lo, hi):
+    """Whether some of the sorted values fall in each interval [lo, hi]."""
+    return (np.searchsorted(values, lo, side='left')
+            < np.searchsorted(values, hi, side='right'))
+
+
+def make_index(boxes):
+    """Index of bounding boxes sorted along x, for use with query_index."""
+    order = np.argsort(boxes[:, 0], kind='stable')
+    width = (boxes[:, 2] - boxes[:, 0]).max()
+    return order, boxes[order, 0], width
+
+
+def query_index(index, xmin, xmax):
+    """Indices of the boxes in index that may overlap the interval xmin, xmax.
+    """
+    order, xmins, width = index
+    start = np.searchsorted(xmins, xmin - width, side='left')
+    stop = np.searchsorted(xmins, xmax, side='right')
+    return order[start:stop]
 
 
 def coverage(pixels, polygon):
-    return np.int32(wn.wn_multipnpoly(pixels, polygon) != 0)
+    """Mask of the pixels covered by polygon, shape (nx*ny,)."""
+    return coverage_all(pixels, polygon[None]) != 0
+
+
+def count_dtype(n):
+    """Smallest signed integer type able to count up to n."""
+    return np.min_scalar_type(-n - 1)
+
 
+def coverage_all(pixels, polygons, workers=None):
+    """Number of polygons covering each pixel.
 
-def coverage_all(pixels, polygons):
-    image = coverage(pixels, polygons[0])
-    for polygon in polygons[1:]:
-        image += coverage(pixels, polygon)
-    return image
+    pixels: axes x, y of the pixel grid, as returned by make_pixels,
+        each either increasing or decreasing
+    polygons: shape (n_polygons, n_vertices, 2), as returned by make_polygons
+    workers: number of threads processing blocks of pixels in parallel,
+        None for the ThreadPoolExecutor default
+    returns: shape (nx*ny,), with the smallest integer type holding
+        n_polygons
+    """
+    x, y = pixels
+    flip = []
+    for axis in (x, y):
+        steps = np.diff(axis)
+        if not ((steps >= 0).all() or (steps <= 0).all()):
+            raise ValueError('pixel axes must be increasing or decreasing')
+        flip.append(len(axis) > 1 and axis[0] > axis[-1])
+    if any(flip):
+        # the culling below works on increasing axes
+        x, y = (axis[::-1] if f else axis for axis, f in zip((x, y), flip))
+        image = coverage_all((x, y), polygons, workers=workers)
+        image = image.reshape(len(x), len(y))
+        image = image[::-1 if flip[0] else 1, ::-1 if flip[1] else 1]
+        return image.reshape(-1)
+    polygons = np.asarray(polygons)
+    boxes = bounding_boxes(polygons)
+    index = make_index(boxes)
+    edges = wn.precompute_edges(polygons)
+    image = np.zeros((len(x), len(y)), dtype=count_dtype(len(polygons)))
+    nrows = max(1, PIXEL_CHUNK // len(y))
+
+    def cover_rows(start):
+        stop = start + nrows
+        xs = x[start:stop]
+        candidates = query_index(index, xs[0], xs[-1])
+        # only polygons whose bounding box contains some pixel of the rows
+        keep = (overlaps(xs, boxes[candidates, 0], boxes[candidates, 2])
+                & overlaps(y, boxes[candidates, 1], boxes[candidates, 3]))
+        if not keep.any():
+            return
+        candidates = candidates[keep]
+        ystart = np.searchsorted(y, boxes[candidates, 1].min(), side='left')
+        ystop = np.searchsorted(y, boxes[candidates, 3].max(), side='right')
+        block_edges = [edge[candidates] for edge in edges]
+        ncols = max(1, L2_CACHE_SIZE // (
+            EDGE_TEST_BYTES * len(xs) * block_edges[0].size))
+        for ys in range(ystart, ystop, ncols):
+            ye = min(ys + ncols, ystop)
+            wns = wn.wn_batchpnpoly(xs[:, None], y[None, ys:ye], block_edges)
+            image[start:stop, ys:ye] = (wns != 0).sum(axis=-1,
+                                                      dtype=image.dtype)
+
+    # blocks write to disjoint rows of image, NumPy releases the GIL
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(cover_rows, range(0, len(x), nrows)))
+    return image.reshape(-1)
+
+
+def coverage_points(points, polygons, workers=None):
+    """Number of polygons covering each point.
+
+    points: shape (n_points, 2), e.g. the healpix pixel centers of
+        make_healpix_pixels
+    polygons: shape (n_polygons, n_vertices, 2), as returned by make_polygons
+    workers: number of threads processing blocks of points in parallel,
+        None for the ThreadPoolExecutor default
+    returns: shape (n_points,), with the smallest integer type holding
+        n_polygons
+    """
+    polygons = np.asarray(polygons)
+    boxes = bounding_boxes(polygons)
+    index = make_index(boxes)
+    edges = wn.precompute_edges(polygons)
+    order = np.argsort(points[:, 0], kind='stable')
+    x, y = points[order, 0], points[order, 1]
+    cover = np.zeros(len(points), dtype=count_dtype(len(polygons)))
+
+    def cover_points(start):
+        stop = start + PIXEL_CHUNK
+        xs, ys = x[start:stop], y[start:stop]
+        candidates = query_index(index, xs[0], xs[-1])
+        # only polygons whose bounding box may contain some point of the block
+        keep = (overlaps(xs, boxes[candidates, 0], boxes[candidates, 2])
+                & (boxes[candidates, 1] <= ys.max())
+                & (boxes[candidates, 3] >= ys.min()))
+        if not keep.any():
+            return
+        block_edges = [edge[candidates[keep]] for edge in edges]
+        npoints = max(1, L2_CACHE_SIZE // (
+            EDGE_TEST_BYTES * block_edges[0].size))
+        for ps in range(start, min(stop, len(x)), npoints):
+            pe = min(ps + npoints, stop)
+            wns = wn.wn_batchpnpoly(x[ps:pe], y[ps:pe], block_edges)
+            cover[order[ps:pe]] = (wns != 0).sum(axis=-1, dtype=cover.dtype)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(cover_points, range(0, len(x), PIXEL_CHUNK)))
+    return cover
+
+
+def coverage_tangent(points, targets, focalplane):
+    """Number of targets whose focal plane covers each point.
+
+    Unlike coverage_points, each point is tested in the tangent plane of
+    each target, against the focal plane itself: no polygon is rotated and
+    the focal plane edges are great circles instead of straight lines in
+    lon, lat. Only points closer to a target than the farthest focal plane
+    vertex are tested.
+
+    points: shape (n_points, 2), unit: degrees, format: lon, lat
+    targets: shape (n_targets, 2), unit: degrees, format: lon, lat
+    focalplane: shape (n_vertices, 2), focal plane polygon at (0, 0)
+    returns: shape (n_points,), with the smallest integer type holding
+        n_targets
+    """
+    vec = geom.to_vec(close_polygon(focalplane))
+    # gnomonic projection around (0, 0), i.e. around the x axis
+    edges = wn.precompute_edges((vec[:, 1:] / vec[:, :1])[None])
+    cos_radius = vec[:, 0].min()
+    r = geom.rot_mat(targets[:, 0], targets[:, 1])
+    centers = r[:, :, 0]
+    points_vec = geom.to_vec(points)
+    cover = np.zeros(len(points), dtype=count_dtype(len(targets)))
+    for start in range(0, len(points), PIXEL_CHUNK):
+        block = points_vec[start:start + PIXEL_CHUNK]
+        ip, it = np.nonzero(block @ centers.T >= cos_radius)
+        # points in the frame of their target: r.T @ p
+        frame = np.einsum('pj,pji->pi', block[ip], r[it])
+        wns = wn.wn_batchpnpoly(frame[:, 1] / frame[:, 0],
+                                frame[:, 2] / frame[:, 0], edges)
+        cover[start:start + len(block)] = np.bincount(
+            ip, weights=wns[:, 0] != 0, minlength=len(block))
+    return cover
 
 
 def make_image(pixels, coverage, extent, size):
@@ -102,6 +314,14 @@ def make_image(pixels, coverage, extent, size):
     return x, y, image
 
 
+def make_healpix_map(nside, ids, coverage):
+    """Full healpix map with the coverage of pixels ids, 0 elsewhere."""
+    import healpy as hp
+    hpmap = np.zeros(hp.nside2npix(nside), dtype=coverage.dtype)
+    hpmap[ids] = coverage
+    return hpmap
+
+
 def make_histogram(pixels, coverage, polygon=None, **kwds):
     if polygon is not None:
         keep = coverage(pixels, polygon)
@@ -123,6 +343,19 @@ def display_image(x, y, image, title=None, clim=None):
     plt.show()
 
 
+def display_healpix_map(hpmap, extent, title=None, clim=None):
+    import healpy as hp
+    from matplotlib import pyplot as plt
+    x0, y0, x1, y1 = extent
+    cmin, cmax = clim if clim is not None else (None, None)
+    # uncovered pixels are left blank, as in display_image
+    hpmap = np.where(hpmap == 0, hp.UNSEEN, hpmap.astype(float))
+    hp.cartview(hpmap, lonra=sorted([x0, x1]), latra=sorted([y0, y1]),
+                min=cmin, max=cmax, title=title)
+    hp.graticule()
+    plt.show()
+
+
 def main():
     parser = argparse.ArgumentParser(description='Sky coverage of targets.')
     parser.add_argument(
@@ -158,6 +391,18 @@ def main():
         type=tuple_of(int),
         help='The size of the output image: nx,ny'
     )
+    parser.add_argument(
+        '--nside',
+        type=int,
+        help='Use the healpix pixels of this nside within the extent '
+             'instead of a rectangular image of the given size'
+    )
+    parser.add_argument(
+        '--tangent',
+        action='store_true',
+        help='Test coverage in the tangent plane of each target, with '
+             'focal plane edges along great circles'
+    )
     parser.add_argument(
         '--display',
         action='store_true',
@@ -188,26 +433,107 @@ def main():
     xmin = xmin - 360 if xmin > 180 else xmin
     xmax = xmax - 360 if xmax > 180 else xmax
     extent = xmin, ymin, xmax, ymax
-    pixels = make_pixels(extent, args.size)
     polygons = make_polygons(targets, focalplane)
-    cover = coverage_all(pixels, polygons)
+
+    if args.nside is not None:
+        ids, lonlat = make_healpix_pixels(extent, args.nside)
+        if args.tangent:
+            cover = coverage_tangent(lonlat, targets, focalplane)
+        else:
+            cover = coverage_points(lonlat, polygons)
+        hpmap = make_healpix_map(args.nside, ids, cover)
+        if args.output is not None:
+            np.savez(args.output, nside=args.nside, extent=extent,
+                     ids=ids, lonlat=lonlat, coverage=cover, map=hpmap,
+                     polygons=polygons, targets=targets)
+        if args.ok is not None:
+            minok, maxok = args.ok
+            # the counts may use a type too small for the ok values
+            hpmap = hpmap.astype(np.int32)
+            hpmap[(hpmap < minok) & (hpmap != 0)] = minok
+            hpmap[hpmap > maxok] = maxok
+        if args.display:
+            display_healpix_map(hpmap, extent, title=args.title,
+                                clim=args.clim)
+        return
+
+    pixels = make_pixels(extent, args.size)
+    if args.tangent:
+        points = np.stack(np.meshgrid(*pixels, indexing='ij'), axis=-1)
+        cover = coverage_tangent(points.reshape(-1, 2), targets, focalplane)
+    else:
+        cover = coverage_all(pixels, polygons)
     x, y, image = make_image(pixels, cover, extent, args.size)
 
     if args.output is not None:
         #print(f'Writing image to {args.output}')
         np.savez(args.output, size=args.size, extent=extent,
-                pixels=pixels, coverage=cover, 
+                pixels_x=pixels[0], pixels_y=pixels[1], coverage=cover,
                 x=x, y=y, image=image,
                 polygons=polygons,
                 targets=targets)
     
     if args.ok is not None:
         minok, maxok = args.ok
+        # the counts may use a type too small for the ok values
+        image = image.astype(np.int32)
         image[(image < minok) & (image != 0)] = minok
         image[image > maxok] = maxok
 
     if args.display:
         display_image(x, y, image, title=args.title, clim=args.clim)
 
+def tests():
+    # non-convex focal plane, overlapping targets and one isolated target
+    focalplane = np.array([[-1, -1], [1, -1], [1.5, 0], [1, 1], [0, 0.3],
+                           [-1, 1]])
+    targets = np.array([[0, 0], [0.7, 0.2], [-0.5, -0.8], [3, 1.5]])
+    polygons = make_polygons(targets, focalplane)
+
+    def brute_force(points):
+        return sum(wn.wn_multipnpoly(points, polygon) != 0
+                   for polygon in polygons)
+
+    for extent, size in [
+        ((-2, -2, 5, 3), (60, 45)),  # increasing axes
+        ((5, -2, -2, 3), (60, 45)),  # decreasing x
+        ((-2, 3, 5, -2), (60, 45)),  # decreasing y
+        ((5, 3, -2, -2), (60, 45)),  # decreasing x and y
+        ((0.2, -2, 0.2, 3), (1, 45)),  # single row
+        ((-2, 0.1, 5, 0.1), (60, 1)),  # single column
+        ((-2, -2, 40, 3), (600, 45)),  # blocks without candidate polygons
+        ((10, 10, 12, 12), (20, 20)),  # no polygon at all
+    ]:
+        pixels = make_pixels(extent, size)
+        points = np.stack(np.meshgrid(*pixels, indexing='ij'), axis=-1)
+        points = points.reshape(-1, 2)
+        expected = brute_force(points)
+        assert (coverage_all(pixels, polygons) == expected).all()
+        assert (coverage_points(points, polygons) == expected).all()
+
+    pixels = make_pixels((-2, -2, 5, 3), (60, 45))
+    assert coverage_all(pixels, polygons).max() == 3
+
+    try:
+        import healpy
+    except ImportError:
+        healpy = None
+    if healpy is not None:
+        ids, lonlat = make_healpix_pixels((-2, -2, 5, 3), 64)
+        assert len(ids) > 0
+        for extent in [(5, -2, -2, 3), (-2, 3, 5, -2), (5, 3, -2, -2)]:
+            reversed_ids, reversed_lonlat = make_healpix_pixels(extent, 64)
+            assert (reversed_ids == ids).all()
+            assert (reversed_lonlat == lonlat).all()
+        assert (coverage_points(lonlat, polygons) == brute_force(lonlat)).all()
+
+    try:
+        coverage_all((np.array([0., 2., 1.]), pixels[1]), polygons)
+    except ValueError:
+        pass
+    else:
+        assert False, 'non-monotonic axes must raise ValueError'
+
+
 if __name__ == '__main__':
     main()
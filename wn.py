@@ -1,46 +1,143 @@
-try:
-    from numba import jit
-except ImportError:
-    jit = lambda func: func
 import numpy as np
 
-@jit
-def is_left(p0, p1, p2):
-    return ((p1[0] - p0[0]) * (p2[1] - p0[1])
-            - (p2[0] - p0[0]) * (p1[1] - p0[1]))
+# use the ahead-of-time compiled functions when built (see build_wn_aot.py),
+# otherwise numba if it is available
+try:
+    import wn_aot
+except ImportError:
+    wn_aot = None
 
 
-@jit
-def wn_pnpoly(p, v):
-    """Winding number of point p in polygon v.
+def aot_arrays(*arrays):
+    """Arrays converted for the wn_aot functions, which do not check types.
 
-    Note: v[0] == v[n-1] (closed polygon)
+    Returns contiguous float32 arrays if all arrays are float32, float64
+    arrays otherwise. Mixing float32 and float64 arrays raises a TypeError.
     """
-    wn = 0
-    n = len(v) - 1
-    for i in range(n):
-        if v[i, 1] <= p[1]:
-            if v[i+1, 1] > p[1]:
-                if is_left(v[i], v[i+1], p) > 0:
-                    wn += 1
-        elif v[i+1, 1] <= p[1]:
-            if is_left(v[i], v[i+1], p) < 0:
-                wn -= 1
-    return wn
+    arrays = [np.asarray(a) for a in arrays]
+    dtypes = {a.dtype for a in arrays}
+    if {np.dtype(np.float32), np.dtype(np.float64)} <= dtypes:
+        raise TypeError('mixed float32 and float64 arrays')
+    dtype = np.float32 if dtypes == {np.dtype(np.float32)} else np.float64
+    return [np.ascontiguousarray(a, dtype=dtype) for a in arrays]
+
+
+if wn_aot is None:
+    try:
+        from numba import jit, njit, prange
+    except ImportError:
+        jit = lambda func: func
+        njit = lambda *args, **kwds: jit
+        prange = range
+
+    @jit
+    def is_left(p0, p1, p2):
+        return ((p1[0] - p0[0]) * (p2[1] - p0[1])
+                - (p2[0] - p0[0]) * (p1[1] - p0[1]))
+
+    @jit
+    def wn_pnpoly(p, v):
+        """Winding number of point p in polygon v.
+
+        Note: v[0] == v[n-1] (closed polygon)
+        """
+        wn = 0
+        n = len(v) - 1
+        for i in range(n):
+            if v[i, 1] <= p[1]:
+                if v[i+1, 1] > p[1]:
+                    if is_left(v[i], v[i+1], p) > 0:
+                        wn += 1
+            elif v[i+1, 1] <= p[1]:
+                if is_left(v[i], v[i+1], p) < 0:
+                    wn -= 1
+        return wn
+
+    @njit(parallel=True, cache=True, fastmath=True)
+    def wn_multipnpoly(ps, v):
+        """Winding number of points ps in polygon v.
+
+        Note: 
+            v[0] == v[n-1] (closed polygon)
+            ps.shape == (np , 2) with np the number of points
+
+        """
+        wn = np.zeros(ps.shape[0], dtype=np.int32)
+        for i in prange(ps.shape[0]):
+            wn[i] = wn_pnpoly(ps[i], v)
+        return wn
 
 
-@jit
-def wn_multipnpoly(ps, v):
-    """Winding number of points ps in polygon v.
+else:
+    def wn_pnpoly(p, v):
+        """Winding number of point p in polygon v, see wn_aot."""
+        p, v = aot_arrays(p, v)
+        if p.dtype == np.float32:
+            return wn_aot.wn_pnpoly_f4(p, v)
+        return wn_aot.wn_pnpoly(p, v)
 
-    Note: 
+    def wn_multipnpoly(ps, v):
+        """Winding number of points ps in polygon v, see wn_aot."""
+        ps, v = aot_arrays(ps, v)
+        if ps.dtype == np.float32:
+            return wn_aot.wn_multipnpoly_f4(ps, v)
+        return wn_aot.wn_multipnpoly(ps, v)
+
+
+def wn_vecpnpoly(ps, v):
+    """Winding number of points ps in polygon v, vectorized over all edges.
+
+    Same result as wn_multipnpoly, computed with NumPy broadcasting over
+    a (np, n-1) array of point/edge pairs instead of a loop.
+
+    Note:
         v[0] == v[n-1] (closed polygon)
         ps.shape == (np , 2) with np the number of points
+    """
+    v0 = v[:-1]
+    v1 = v[1:]
+    px = ps[:, None, 0]
+    py = ps[:, None, 1]
+    left = ((v1[:, 0] - v0[:, 0]) * (py - v0[:, 1])
+            - (px - v0[:, 0]) * (v1[:, 1] - v0[:, 1]))
+    cross = np.subtract(v0[:, 1] <= py, v1[:, 1] <= py, dtype=np.int8)
+    wn = np.sum(cross * (cross * left > 0), axis=1, dtype=np.int32)
+    return wn
+
+
+def precompute_edges(vs):
+    """Edge arrays of polygons vs used by wn_batchpnpoly.
+
+    Note:
+        vs[..., 0, :] == vs[..., n-1, :] (closed polygons)
+        vs.shape == (..., n, 2)
+    returns v0x, v0y, v1y, dx, dy: start point, end point ordinate and
+        extent of each edge, shapes (..., n-1)
+    """
+    v0 = vs[..., :-1, :]
+    v1 = vs[..., 1:, :]
+    return tuple(np.ascontiguousarray(a) for a in (
+        v0[..., 0], v0[..., 1], v1[..., 1],
+        v1[..., 0] - v0[..., 0], v1[..., 1] - v0[..., 1]))
+
+
+def wn_batchpnpoly(x, y, edges):
+    """Winding numbers of points (x, y) in each of the polygons with edges.
 
+    Note:
+        x, y are arrays of point coordinates broadcastable together, e.g.
+        x[:, None] and y[None, :] for the points of a grid
+        edges = precompute_edges(vs), with vs.shape == (nv, n, 2)
+    returns wn: shape np.broadcast(x, y).shape + (nv,)
     """
-    wn = np.zeros(len(ps), dtype=np.int32)
-    for i, p in enumerate(ps):
-        wn[i] = wn_pnpoly(p, v)
+    v0x, v0y, v1y, dx, dy = edges
+    px = x[..., None, None]
+    py = y[..., None, None]
+    left = dx * (py - v0y) - (px - v0x) * dy
+    # +1 for an upward crossing, -1 for a downward one, 0 otherwise
+    cross = np.subtract(v0y <= py, v1y <= py, dtype=np.int8)
+    # counted when p is left of an upward edge or right of a downward one
+    wn = np.sum(cross * (cross * left > 0), axis=-1, dtype=np.int32)
     return wn
 
 
@@ -54,6 +151,14 @@ def tests():
     assert wn_pnpoly(p, v) == 1
     p = np.array([1, 1])
     assert wn_pnpoly(p, v) == 0
+    ps = np.array([[0, 0], [1, 1], [0, -0.5], [-2, 0]], dtype=float)
+    assert (wn_vecpnpoly(ps, v) == wn_multipnpoly(ps, v)).all()
+    ps32, v32 = ps.astype(np.float32), v.astype(np.float32)
+    assert (wn_multipnpoly(ps32, v32) == wn_multipnpoly(ps, v)).all()
+    vs = np.stack([v, v + 1])
+    wns = wn_batchpnpoly(ps[:, 0], ps[:, 1], precompute_edges(vs))
+    assert (wns[:, 0] == wn_vecpnpoly(ps, v)).all()
+    assert (wns[:, 1] == wn_vecpnpoly(ps, v + 1)).all()
 
 
 def demo():